@@ -1,22 +1,54 @@
 # agent.py
 from __future__ import annotations
 
+import asyncio
+import functools
 import operator
-from statistics import mean, pstdev
+import re
+import threading
+import time
+from collections import OrderedDict
 from typing import Any, Dict, List, Optional, Sequence, TypedDict
 
+import numpy as np
 from typing_extensions import Annotated
 
 from langchain_core.messages import AnyMessage, AIMessage, HumanMessage
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 
-from qdrant_client import QdrantClient
-from qdrant_client.models import SearchParams
-from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
+from qdrant_client import AsyncQdrantClient
+from langchain_openai import AzureChatOpenAI
+from openai import AsyncAzureOpenAI
 
 from .config import settings
 from .firestore_memory import get_user_metrics
+from .retriever import search_params
+
+
+def _merge_metrics(
+    left: Optional[Dict[str, Dict[str, Any]]],
+    right: Optional[Dict[str, Dict[str, Any]]],
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Reducer for columnar metrics: concatenate the ts/value arrays per kind.
+    """
+    if not left:
+        return dict(right or {})
+    if not right:
+        return left
+    out = dict(left)
+    for k, col in right.items():
+        prev = out.get(k)
+        if prev is None:
+            out[k] = col
+        else:
+            out[k] = {
+                "ts": np.concatenate([prev["ts"], col["ts"]]),
+                "value": np.concatenate([prev["value"], col["value"]]),
+                "unit": prev.get("unit") or col.get("unit"),
+            }
+    return out
 
 
 class AgentState(TypedDict):
@@ -36,7 +68,7 @@ class AgentState(TypedDict):
     question: Optional[str]
 
     # User data & derived analytics
-    metrics: Annotated[List[Dict[str, Any]], operator.add]
+    metrics: Annotated[Dict[str, Dict[str, Any]], _merge_metrics]  # {kind: {"ts", "value", "unit"}}
     stats: Optional[Dict[str, Any]]
     anomalies: Annotated[List[str], operator.add]
 
@@ -49,24 +81,30 @@ class AgentState(TypedDict):
     answer: Optional[str]
 
 
-def _qdrant() -> QdrantClient:
-    return QdrantClient(
+@functools.lru_cache(maxsize=1)
+def _qdrant() -> AsyncQdrantClient:
+    return AsyncQdrantClient(
         host=settings.qdrant_host,
         port=settings.qdrant_port,
-        prefer_grpc=False,
+        grpc_port=settings.qdrant_grpc_port,
+        prefer_grpc=settings.qdrant_prefer_grpc,
         timeout=20.0,
     )
 
 
-def _embedder() -> AzureOpenAIEmbeddings:
-    return AzureOpenAIEmbeddings(
-        azure_deployment=settings.azure_embedding_deployment,
+@functools.lru_cache(maxsize=1)
+def _azure() -> AsyncAzureOpenAI:
+    """Raw Azure client for query embeddings (skips the LangChain wrapper)."""
+    return AsyncAzureOpenAI(
         api_key=settings.azure_openai_key,
         azure_endpoint=settings.azure_openai_endpoint,
         api_version=settings.azure_api_version,
+        max_retries=3,
+        timeout=10.0,
     )
 
 
+@functools.lru_cache(maxsize=1)
 def _chat() -> AzureChatOpenAI:
     return AzureChatOpenAI(
         azure_deployment=settings.azure_deployment_name,
@@ -78,33 +116,167 @@ def _chat() -> AzureChatOpenAI:
     )
 
 
-def _mean_sd(values: List[float]) -> tuple[Optional[float], Optional[float]]:
-    if not values:
-        return None, None
-    if len(values) == 1:
-        return float(values[0]), 0.0
-    return float(mean(values)), float(pstdev(values))
+_EMBED_CACHE: "OrderedDict[str, List[float]]" = OrderedDict()
+_EMBED_LOCK = threading.Lock()
+
+
+async def _embed_query(text: str) -> List[float]:
+    """
+    Embed a query, memoized on the normalized text (LRU, bounded by settings).
+    """
+    key = " ".join(text.lower().split())
+    with _EMBED_LOCK:
+        vec = _EMBED_CACHE.get(key)
+        if vec is not None:
+            _EMBED_CACHE.move_to_end(key)
+            return vec
+
+    resp = await _azure().embeddings.create(
+        model=settings.azure_embedding_deployment, input=[text]
+    )
+    vec = resp.data[0].embedding
+
+    with _EMBED_LOCK:
+        _EMBED_CACHE[key] = vec
+        _EMBED_CACHE.move_to_end(key)
+        while len(_EMBED_CACHE) > settings.embedding_cache_size:
+            _EMBED_CACHE.popitem(last=False)
+    return vec
+
+
+class _NearestQueryCache:
+    """
+    Retrieval results keyed by query vector. A lookup hits when a cached query is
+    within `threshold` cosine similarity and younger than `ttl` seconds; expired
+    entries are reused first, then the least recently used once `capacity` is reached.
+    Entries expire rather than rely on clear(): other workers/instances never see a
+    local clear, and wait=False index writes may land after it.
+    """
+
+    def __init__(self, capacity: int, threshold: float, ttl: float) -> None:
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._vecs: Optional[np.ndarray] = None  # unit-normalized rows, grown on demand
+            self._results: List[Any] = []
+            self._last_used: List[int] = []
+            self._expires: List[float] = []
+            self._tick = 0
+
+    @staticmethod
+    def unit(vector: Sequence[float]) -> Optional[np.ndarray]:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(v))
+        return v / norm if norm else None
+
+    def get(self, v: np.ndarray) -> Any:
+        with self._lock:
+            n = len(self._results)
+            if not n or self._vecs is None or self._vecs.shape[1] != v.size:
+                return None
+            sims = self._vecs[:n] @ v
+            sims[np.asarray(self._expires) <= time.monotonic()] = -np.inf
+            i = int(np.argmax(sims))
+            if sims[i] < self.threshold:
+                return None
+            self._tick += 1
+            self._last_used[i] = self._tick
+            return self._results[i]
+
+    def put(self, v: np.ndarray, result: Any) -> None:
+        if self.capacity <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            if self._vecs is None or self._vecs.shape[1] != v.size:
+                self._vecs = np.empty((min(64, self.capacity), v.size), dtype=np.float32)
+                self._results, self._last_used, self._expires = [], [], []
+            now = time.monotonic()
+            n = len(self._results)
+            expired = np.flatnonzero(np.asarray(self._expires) <= now) if n else ()
+            if len(expired):
+                i = int(expired[0])
+                self._results[i] = result
+            elif n < self.capacity:
+                if n == self._vecs.shape[0]:
+                    grown = np.empty((min(self.capacity, 2 * n), v.size), dtype=np.float32)
+                    grown[:n] = self._vecs
+                    self._vecs = grown
+                i = n
+                self._results.append(result)
+                self._last_used.append(0)
+                self._expires.append(0.0)
+            else:
+                i = min(range(n), key=self._last_used.__getitem__)
+                self._results[i] = result
+            self._vecs[i] = v
+            self._expires[i] = now + self.ttl
+            self._tick += 1
+            self._last_used[i] = self._tick
+
+
+_RETRIEVAL_CACHE = _NearestQueryCache(
+    capacity=settings.retrieval_cache_size,
+    threshold=settings.retrieval_cache_threshold,
+    ttl=settings.retrieval_cache_ttl,
+)
 
 
-def _safe_float(x: Any) -> Optional[float]:
-    try:
-        return float(x)
-    except Exception:
-        return None
+def clear_retrieval_cache() -> None:
+    """Drop this process's cached retrieval results; other processes rely on the TTL."""
+    _RETRIEVAL_CACHE.clear()
+
+
+def _summarize(
+    arr: np.ndarray, z: float = 2.5
+) -> tuple[Optional[float], Optional[float], int, int]:
+    """
+    Return (mean, population stdev, count, outliers beyond ±z·stdev). The deviation
+    array is computed once and feeds both the sum of squares and the outlier count.
+    """
+    n = int(arr.size)
+    if n == 0:
+        return None, None, 0, 0
+    mu = arr.mean(dtype=np.float64)
+    dev = arr - mu
+    sd = float(np.sqrt(np.dot(dev, dev) / n))
+    n_out = int(np.count_nonzero(np.abs(dev) > z * sd)) if sd > 0 else 0
+    return float(mu), sd, n, n_out
+
+
+_MIN_TRUNCATED_TEXT = 80
 
 
 def _format_context(chunks: List[Dict[str, Any]], max_chars: int = 4000) -> str:
+    """
+    Render chunks as [SOURCE] blocks within max_chars. The chunk that crosses the
+    budget keeps its full header and a truncated text if at least
+    _MIN_TRUNCATED_TEXT characters fit; otherwise it is dropped.
+    """
     pieces: List[str] = []
-    used = 0
+    append = pieces.append
+    budget = max_chars
     for r in chunks:
-        text = r.get("text") or r.get("payload", {}).get("text") or ""
-        meta = r.get("metadata") or r.get("payload") or {}
+        if pieces:
+            budget -= 1  # "\n" separator from the join
+        get = r.get
+        payload = get("payload") or {}
+        text = get("text") or payload.get("text") or ""
+        meta = get("metadata") or payload
         src = meta.get("source") or meta.get("url") or meta.get("id") or "unknown"
-        part = f"[SOURCE: {src}]\n{text}\n"
-        if used + len(part) > max_chars:
+        header = f"[SOURCE: {src}]\n"
+        room = budget - len(header) - 1  # trailing "\n"
+        if len(text) > room:
+            if room >= _MIN_TRUNCATED_TEXT:
+                append(f"{header}{text[:room]}\n")
             break
-        pieces.append(part)
-        used += len(part)
+        part = f"{header}{text}\n"
+        append(part)
+        budget -= len(part)
     return "\n".join(pieces)
 
 
@@ -125,24 +297,36 @@ SYSTEM_INSTRUCTIONS = (
     "Do not provide diagnosis or dosing; be concise and structured."
 )
 
+# Static prompt pieces, built once at import
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_INSTRUCTIONS}
+
+_ANSWER_INSTRUCTIONS = (
+    "Instructions:\n"
+    "- Personalize using the user's metrics.\n"
+    "- Use ONLY the provided context for claims; add bracketed citations.\n"
+    "- If context is insufficient, say so and suggest what data or timeframe would help.\n"
+    "- Keep the answer under ~180 words.\n"
+)
+
+_DISCLAIMER = (
+    "Note: This is general information based on your data and referenced materials, "
+    "not medical advice. For diagnosis, dosing, or urgent issues, consult a clinician "
+    "or seek in-person care."
+)
+
 
 def node_parse_user(state: AgentState) -> AgentState:
     """
     Parse the latest user message, initialize list-merged fields.
     """
-    question: Optional[str] = None
-    for msg in reversed(state["messages"]):
-        if isinstance(msg, HumanMessage):
-            question = (msg.content or "").strip()
-            break
-        if isinstance(msg, dict) and msg.get("type") == "human":
-            question = str(msg.get("content") or "").strip()
-            break
+    # add_messages coerces inputs to message objects, so only HumanMessage can occur
+    last = next((m for m in reversed(state["messages"]) if isinstance(m, HumanMessage)), None)
+    question = (last.content or "").strip() if last else None
 
     return {
         "question": question,
         "metric_kinds": state.get("metric_kinds") or [],
-        "metrics": [],
+        "metrics": {},
         "anomalies": [],
         "relevant_chunks": [],
         "citations": [],
@@ -150,7 +334,7 @@ def node_parse_user(state: AgentState) -> AgentState:
     }
 
 
-def node_pull_metrics(state: AgentState) -> AgentState:
+async def node_pull_metrics(state: AgentState) -> AgentState:
     """
     Fetch metrics from Firestore for user_id/timeframe/kinds.
     """
@@ -159,86 +343,101 @@ def node_pull_metrics(state: AgentState) -> AgentState:
     kinds = state.get("metric_kinds") or []
 
     if not user_id or not timeframe.get("start") or not timeframe.get("end"):
-        return {"metrics": []}
+        return {"metrics": {}}
 
-    data = get_user_metrics(
+    data = await asyncio.to_thread(
+        get_user_metrics,
         user_id=user_id,
         start_iso=timeframe["start"],
         end_iso=timeframe["end"],
         kinds=kinds,
     )
-
-    cleaned: List[Dict[str, Any]] = []
-    for p in data or []:
-        cleaned.append(
-            {
-                "kind": p.get("kind"),
-                "ts": p.get("ts"),
-                "value": _safe_float(p.get("value")),
-                "unit": p.get("unit"),
-            }
-        )
-    return {"metrics": cleaned}
+    # Already columnar with float32 values; no per-point cleanup needed
+    return {"metrics": data or {}}
 
 
 def node_analyze(state: AgentState) -> AgentState:
     """
     Compute per-kind aggregates and simple z-score outlier flags.
     """
-    points = state.get("metrics") or []
-    by_kind: Dict[str, List[float]] = {}
-    for p in points:
-        v = _safe_float(p.get("value"))
-        k = p.get("kind")
-        if v is None or not k:
-            continue
-        by_kind.setdefault(k, []).append(v)
+    columns = state.get("metrics") or {}
 
     stats: Dict[str, Any] = {}
     flags: List[str] = []
-    for k, vals in by_kind.items():
-        mu, sd = _mean_sd(vals)
-        stats[k] = {"mean": mu, "stdev": sd, "n": len(vals)}
-        if mu is not None and sd and sd > 0:
-            lo, hi = mu - 2.5 * sd, mu + 2.5 * sd
-            outliers = [v for v in vals if v < lo or v > hi]
-            if outliers:
-                flags.append(f"{k}: {len(outliers)} outlier(s) beyond ±2.5σ")
+    for k, col in columns.items():
+        mu, sd, n, n_out = _summarize(col["value"])
+        if not n:
+            continue
+        stats[k] = {"mean": mu, "stdev": sd, "n": n}
+        if n_out:
+            flags.append(f"{k}: {n_out} outlier(s) beyond ±2.5σ")
 
     return {"stats": stats, "anomalies": flags}
 
 
-def node_retrieve(state: AgentState) -> AgentState:
+_RETRIEVE_K = 6
+
+# Retrieval is skipped only for questions that are clearly a lookup of the user's own
+# aggregate ("what was my average HR last week?") with nothing after the time window.
+# Anything else, including anything unsure, keeps guideline retrieval.
+_METRIC = r"(resting )?(hr|heart rate|hrv|steps?|step count|sleep)"
+_WINDOW = (
+    r"( (today|yesterday|tonight|last night"
+    r"|(in |over |for |during )?(the )?(this|last|past)( \d+)? (day|night|week|month)s?))?"
+)
+_METRIC_ONLY_RE = re.compile(
+    r"\s*(what( was|'s| is)|how many)\s+"
+    r"(my (average|avg|mean|total|median) " + _METRIC
+    + r"|the (average|mean|total|median) (of )?my " + _METRIC
+    + r"|steps did i (take|walk|do)|hours of sleep did i get)"
+    + _WINDOW + r"\s*\??\s*",
+    re.IGNORECASE,
+)
+# Guard for the pattern above: stems, not exact words, so "recommended" or
+# "dangerous" also count, plus symptom wording
+_NEEDS_GUIDANCE_RE = re.compile(
+    r"\b(why|should|recommend\w*|normal|bad|good|health\w*|concern\w*|worr\w*|what does"
+    r"|danger\w*|safe\w*|risk\w*|need\w*|tips?|improv\w*|high\w*|low\w*|too"
+    r"|(does|do|would|could) (it|that|this) mean|means? (if|when|that|for)"
+    r"|feel\w*|dizz\w*|faint\w*|pain\w*|chest|breath\w*|symptom\w*|spik\w*|palpitat\w*)\b",
+    re.IGNORECASE,
+)
+
+
+def _is_metric_only(q: str) -> bool:
+    return bool(_METRIC_ONLY_RE.fullmatch(q)) and not _NEEDS_GUIDANCE_RE.search(q)
+
+
+async def node_retrieve(state: AgentState) -> AgentState:
     """
-    Retrieve guidance from Qdrant, lightly enriched with metric stats.
+    Retrieve guidance from Qdrant for the question.
+    Runs in parallel with the metrics branch, so it does not depend on stats.
+    Skipped for metric-only questions.
     """
     q = (state.get("question") or "").strip()
-    if not q:
+    if not q or _is_metric_only(q):
         return {"relevant_chunks": [], "citations": []}
 
-    stats = state.get("stats") or {}
-    enrich: List[str] = []
-    for k in ("hr", "hrv", "sleep", "steps"):
-        if k in stats and stats[k].get("mean") is not None:
-            enrich.append(f"{k} mean {stats[k]['mean']:.1f}")
-    enriched = q if not enrich else f"{q} | {'; '.join(enrich)}"
+    vector = await _embed_query(q)
+    unit = _NearestQueryCache.unit(vector)
+    cached = _RETRIEVAL_CACHE.get(unit) if unit is not None else None
+    if cached is not None:
+        chunks, cites = cached
+        return {"relevant_chunks": list(chunks), "citations": list(cites)}
 
     client = _qdrant()
-    emb = _embedder()
-    vector = emb.embed_query(enriched)
-
-    results = client.search(
+    results = await client.query_points(
         collection_name=settings.qdrant_collection,
-        query_vector=vector,
-        limit=6,
+        query=vector,
+        limit=_RETRIEVE_K,
         with_payload=True,
         with_vectors=False,
-        search_params=SearchParams(hnsw_ef=128),
+        search_params=search_params(_RETRIEVE_K),
     )
 
     chunks: List[Dict[str, Any]] = []
     cites: List[Dict[str, Any]] = []
-    for hit in results:
+    for hit in results.points:
         payload = hit.payload or {}
         text = payload.get("text") or payload.get("page_content") or ""
         meta = {
@@ -247,9 +446,12 @@ def node_retrieve(state: AgentState) -> AgentState:
             "title": payload.get("title"),
             "chunk": payload.get("chunk") or payload.get("chunk_id"),
         }
-        chunks.append({"text": text, "score": float(hit.score or 0.0), "metadata": meta})
-        cites.append({"id": meta["id"], "source": meta["source"], "score": float(hit.score or 0.0)})
+        score = hit.score  # ScoredPoint.score is always a float
+        chunks.append({"text": text, "score": score, "metadata": meta})
+        cites.append({"id": meta["id"], "source": meta["source"], "score": score})
 
+    if unit is not None:
+        _RETRIEVAL_CACHE.put(unit, (chunks, cites))
     return {"relevant_chunks": chunks, "citations": cites}
 
 
@@ -262,14 +464,17 @@ EMERGENCY_SIGNS = (
     "unconscious",
 )
 
+# One alternation scanned in a single pass, instead of one substring search per sign
+_EMERGENCY_RE = re.compile("|".join(map(re.escape, EMERGENCY_SIGNS)), re.IGNORECASE)
+
 
 def node_safety(state: AgentState) -> AgentState:
     """
     Very lightweight safety heuristics. Replace with a guardrail service as needed.
     """
     warnings: List[str] = []
-    q = (state.get("question") or "").lower()
-    if any(k in q for k in EMERGENCY_SIGNS):
+    q = state.get("question") or ""
+    if _EMERGENCY_RE.search(q):
         warnings.append("Possible emergency symptoms mentioned — advise urgent in-person care.")
 
     anomalies = state.get("anomalies") or []
@@ -279,16 +484,17 @@ def node_safety(state: AgentState) -> AgentState:
     return {"safety_warnings": warnings}
 
 
-def node_answer(state: AgentState) -> AgentState:
+async def node_answer(state: AgentState) -> AgentState:
     """
     Compose the final answer, with citations and disclaimer.
     """
-    question = state.get("question") or ""
-    stats = state.get("stats") or {}
-    anomalies = state.get("anomalies") or []
-    chunks = state.get("relevant_chunks") or []
-    citations = state.get("citations") or []
-    safety = state.get("safety_warnings") or []
+    get = state.get
+    question = get("question") or ""
+    stats = get("stats") or {}
+    anomalies = get("anomalies") or []
+    chunks = get("relevant_chunks") or []
+    citations = get("citations") or []
+    safety = get("safety_warnings") or []
 
     # Metrics summary
     parts: List[str] = []
@@ -304,38 +510,26 @@ def node_answer(state: AgentState) -> AgentState:
 
     context = _format_context(chunks)
     cites = _citation_block(citations)
-    disclaimer = (
-        "Note: This is general information based on your data and referenced materials, "
-        "not medical advice. For diagnosis, dosing, or urgent issues, consult a clinician "
-        "or seek in-person care."
-    )
 
-    user_prompt = (
-        f"Question:\n{question}\n\n"
-        f"Your recent metrics (summary):\n{metrics_summary}\n"
-    )
+    prompt: List[str] = [
+        f"Question:\n{question}\n\n",
+        f"Your recent metrics (summary):\n{metrics_summary}\n",
+    ]
     if anomalies:
-        user_prompt += "\nDetected anomalies:\n- " + "\n- ".join(anomalies) + "\n"
-    user_prompt += "\nContext (verbatim excerpts):\n" + context + "\n\n"
-    user_prompt += (
-        "Instructions:\n"
-        "- Personalize using the user's metrics.\n"
-        "- Use ONLY the provided context for claims; add bracketed citations.\n"
-        "- If context is insufficient, say so and suggest what data or timeframe would help.\n"
-        "- Keep the answer under ~180 words.\n"
-    )
+        prompt.append("\nDetected anomalies:\n- " + "\n- ".join(anomalies) + "\n")
+    if context:
+        prompt.append("\nContext (verbatim excerpts):\n" + context + "\n\n")
+    else:
+        prompt.append("\nContext: none retrieved; answer from the user's metrics summary.\n\n")
+    prompt.append(_ANSWER_INSTRUCTIONS)
     if safety:
-        user_prompt += "\nSafety considerations:\n- " + "\n- ".join(safety) + "\n"
+        prompt.append("\nSafety considerations:\n- " + "\n- ".join(safety) + "\n")
     if cites:
-        user_prompt += f"\nSources:\n{cites}\n"
+        prompt.append(f"\nSources:\n{cites}\n")
 
     llm = _chat()
-    messages = [
-        {"role": "system", "content": SYSTEM_INSTRUCTIONS},
-        {"role": "user", "content": user_prompt},
-    ]
-    resp = llm.invoke(messages)
-    content = (resp.content or "").strip() + "\n\n" + disclaimer
+    resp = await llm.ainvoke([_SYSTEM_MSG, {"role": "user", "content": "".join(prompt)}])
+    content = (resp.content or "").strip() + "\n\n" + _DISCLAIMER
 
     return {"answer": content, "messages": [AIMessage(content=content)]}
 
@@ -350,10 +544,11 @@ def build_graph():
     builder.add_node("answer", node_answer)
 
     builder.add_edge(START, "parse_user")
+    # Metrics (Firestore) and guidance (embedding + Qdrant) are independent branches
     builder.add_edge("parse_user", "pull_metrics")
+    builder.add_edge("parse_user", "retrieve_guidance")
     builder.add_edge("pull_metrics", "analyze_metrics")
-    builder.add_edge("analyze_metrics", "retrieve_guidance")
-    builder.add_edge("retrieve_guidance", "safety")
+    builder.add_edge(["analyze_metrics", "retrieve_guidance"], "safety")
     builder.add_edge("safety", "answer")
     builder.add_edge("answer", END)
 
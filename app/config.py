@@ -1,3 +1,4 @@
+from dataclasses import dataclass, make_dataclass
 from typing import Optional
 from pydantic_settings import BaseSettings
 from pydantic import Field
@@ -16,9 +17,32 @@ class Settings(BaseSettings):
 
     qdrant_host: str = Field(default="127.0.0.1", alias="QDRANT_HOST")
     qdrant_port: int = Field(default=6333, alias="QDRANT_PORT")
+    qdrant_grpc_port: int = Field(default=6334, alias="QDRANT_GRPC_PORT")
+    qdrant_prefer_grpc: bool = Field(default=True, alias="QDRANT_PREFER_GRPC")
     qdrant_collection: str = Field(default="memory", alias="QDRANT_COLLECTION")
     qdrant_distance: str = Field(default="COSINE", alias="QDRANT_DISTANCE")
+    qdrant_hnsw_m: int = Field(default=16, alias="QDRANT_HNSW_M")
+    qdrant_hnsw_ef_construct: int = Field(default=200, alias="QDRANT_HNSW_EF_CONSTRUCT")
+    qdrant_on_disk_payload: bool = Field(default=False, alias="QDRANT_ON_DISK_PAYLOAD")
+    qdrant_indexed_payload_keys: list[str] = Field(
+        default=["category"],
+        alias="QDRANT_INDEXED_PAYLOAD_KEYS",
+        description="Payload keys to keyword-index for filtered search",
+    )
+    qdrant_hnsw_ef_base: int = Field(default=64, alias="QDRANT_HNSW_EF_BASE")
+    qdrant_hnsw_ef_multiplier: int = Field(default=4, alias="QDRANT_HNSW_EF_MULTIPLIER")
+    qdrant_hnsw_ef_max: int = Field(default=512, alias="QDRANT_HNSW_EF_MAX")
+    qdrant_upsert_batch_size: int = Field(default=32, alias="QDRANT_UPSERT_BATCH_SIZE")
+    qdrant_upsert_concurrency: int = Field(default=2, alias="QDRANT_UPSERT_CONCURRENCY")
+    qdrant_scalar_quantization: bool = Field(default=True, alias="QDRANT_SCALAR_QUANTIZATION")
+    qdrant_oversampling: float = Field(default=2.0, alias="QDRANT_OVERSAMPLING")
     embedding_dim: int = Field(default=1536, alias="EMBEDDING_DIM")
+    retrieval_cache_size: int = Field(default=4096, alias="RETRIEVAL_CACHE_SIZE")
+    retrieval_cache_threshold: float = Field(default=0.98, alias="RETRIEVAL_CACHE_THRESHOLD")
+    retrieval_cache_ttl: float = Field(default=300.0, alias="RETRIEVAL_CACHE_TTL")
+    embedding_cache_size: int = Field(default=4096, alias="EMBEDDING_CACHE_SIZE")
+    embedding_batch_size: int = Field(default=64, alias="EMBEDDING_BATCH_SIZE")
+    embedding_concurrency: int = Field(default=8, alias="EMBEDDING_CONCURRENCY")
 
     gcp_project_id: str = Field(..., alias="GCP_PROJECT_ID")
     firestore_collection: str = Field(default="conversations")
@@ -44,4 +68,27 @@ class Settings(BaseSettings):
         env_file = ".env"
         env_file_encoding = "utf-8"
 
-settings = Settings()
+# Env is parsed and validated once; the app reads from a frozen, slotted snapshot
+FrozenSettings = make_dataclass(
+    "FrozenSettings",
+    [(name, field.annotation) for name, field in Settings.model_fields.items()],
+    frozen=True,
+    slots=True,
+)
+
+settings = FrozenSettings(**Settings().model_dump())
+
+
+@dataclass(slots=True)
+class MetricConfig:
+    """Metric kinds that can be changed at runtime via the config endpoint."""
+
+    default_metric_kinds: list[str]
+    available_metric_kinds: list[str]
+
+
+metric_config = MetricConfig(
+    default_metric_kinds=list(settings.default_metric_kinds),
+    available_metric_kinds=list(settings.available_metric_kinds),
+)
+
@@ -1,10 +1,13 @@
 # firestore_memory.py
 from __future__ import annotations
 
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import chain
 import os
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
+import numpy as np
 from google.cloud import firestore
 
 from .config import settings
@@ -41,9 +44,20 @@ def fetch_context(user_id: str, limit: Optional[int] = None) -> List[Dict]:
     return messages[-limit:]
 
 
-def append_turn(user_id: str, role: str, content: str) -> None:
-    now = datetime.now(timezone.utc).isoformat()
-    _conv_ref(user_id).add({"role": role, "content": content, "created_at": now})
+def append_turns(user_id: str, turns: Sequence[Tuple[str, str]]) -> None:
+    """
+    Persist several (role, content) turns in one WriteBatch (single round trip).
+    Timestamps are offset by 1µs per turn so fetch_context keeps their order.
+    """
+    if not turns:
+        return
+    ref = _conv_ref(user_id)
+    batch = _db.batch()
+    now = datetime.now(timezone.utc)
+    for i, (role, content) in enumerate(turns):
+        created_at = (now + timedelta(microseconds=i)).isoformat()
+        batch.set(ref.document(), {"role": role, "content": content, "created_at": created_at})
+    batch.commit()
 
 
 # -----------------------------
@@ -77,64 +91,93 @@ def _parse_iso_utc(s: str) -> datetime:
     return dt.astimezone(timezone.utc)
 
 
+_IN_QUERY_LIMIT = 10
+_METRIC_FIELDS = ["kind", "ts", "value", "unit"]
+
+
+def _epoch_seconds(ts_val) -> Optional[int]:
+    if isinstance(ts_val, datetime):
+        if ts_val.tzinfo is None:
+            ts_val = ts_val.replace(tzinfo=timezone.utc)
+        return int(ts_val.timestamp())
+    try:
+        return int(_parse_iso_utc(str(ts_val)).timestamp())
+    except ValueError:
+        return None
+
+
 def get_user_metrics(
     user_id: str,
     start_iso: str,
     end_iso: str,
     kinds: List[str] | None = None,
-) -> List[Dict]:
+) -> Dict[str, Dict[str, Any]]:
     """
     Fetch metric points for a user within [start_iso, end_iso] (inclusive),
     optionally filtered to specific kinds.
-    Returns:
-      [{"kind": str, "ts": "<ISO8601 UTC>", "value": float, "unit": str}, ...]
+    Returns columns per kind, each ordered by ts:
+      {kind: {"ts": ndarray[datetime64[s]], "value": ndarray[float32], "unit": str}, ...}
     """
     start_dt = _parse_iso_utc(start_iso)
     end_dt = _parse_iso_utc(end_iso)
 
-    q = (
+    # Served by the (kind ASC, ts ASC) composite index in firestore.indexes.json;
+    # the projection keeps any extra document fields off the wire.
+    base = (
         _metrics_ref(user_id)
+        .select(_METRIC_FIELDS)
         .where("ts", ">=", start_dt)
         .where("ts", "<=", end_dt)
         .order_by("ts")
     )
 
     if kinds:
+        # Firestore "in" accepts at most 10 values; fan out one query per chunk.
+        # A kind lives in exactly one chunk, so per-kind ts order survives the merge.
         uniq = list(dict.fromkeys(kinds))
-        if len(uniq) <= 10:
-            q = q.where("kind", "in", uniq)
-        # if > 10, fallback to client-side filter below
-
-    docs = q.stream()
-
-    out: List[Dict] = []
+        chunks = [uniq[i : i + _IN_QUERY_LIMIT] for i in range(0, len(uniq), _IN_QUERY_LIMIT)]
+        queries = [base.where("kind", "in", c) for c in chunks]
+    else:
+        queries = [base]
+
+    if len(queries) == 1:
+        docs = queries[0].get()
+    else:
+        with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+            docs = list(chain.from_iterable(pool.map(lambda q: q.get(), queries)))
+
+    ts_cols: Dict[str, List[int]] = {}
+    value_cols: Dict[str, List[float]] = {}
+    units: Dict[str, Any] = {}
     for d in docs:
         data = d.to_dict() or {}
         k = data.get("kind")
-        if kinds and len(kinds) > 10 and k not in kinds:
+        if not k:
             continue
 
-        ts_val = data.get("ts")
-        if isinstance(ts_val, datetime):
-            ts_iso = ts_val.astimezone(timezone.utc).isoformat()
-        else:
-            ts_iso = str(ts_val)
+        ts = _epoch_seconds(data.get("ts"))
+        if ts is None:
+            continue
 
         try:
             val = float(data.get("value"))
         except Exception:
             continue
 
-        out.append(
-            {
-                "kind": k,
-                "ts": ts_iso,
-                "value": val,
-                "unit": data.get("unit"),
-            }
-        )
-
-    return out
+        if k not in value_cols:
+            ts_cols[k], value_cols[k] = [], []
+            units[k] = data.get("unit")
+        ts_cols[k].append(ts)
+        value_cols[k].append(val)
+
+    return {
+        k: {
+            "ts": np.array(ts_cols[k], dtype="datetime64[s]"),
+            "value": np.fromiter(vals, dtype=np.float32, count=len(vals)),
+            "unit": units[k],
+        }
+        for k, vals in value_cols.items()
+    }
 
 
 def add_metric(
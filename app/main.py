@@ -1,25 +1,30 @@
 # main.py
 from __future__ import annotations
 
+import asyncio
 import json
+import logging
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
-from typing import Any, AsyncGenerator, Dict, List, Optional
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List, Optional, Set
 
 from dotenv import load_dotenv
 from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
 from openai import AzureOpenAI
 
-from .agent import GRAPH
-from .config import settings
-from .firestore_memory import append_turn, fetch_context
-from .retriever import delete_points, search, upsert_texts
+from .agent import GRAPH, clear_retrieval_cache
+from .config import metric_config, settings
+from .firestore_memory import append_turns, fetch_context
+from .retriever import delete_points, search, search_many, upsert_texts
 from .schemas import (
     ChatRequest,
     ChatResponse,
     DeleteRequest,
+    SearchBatchRequest,
+    SearchBatchResponse,
     SearchRequest,
     SearchResponse,
     UpsertRequest,
@@ -30,7 +35,37 @@ from .security import api_key_auth
 
 load_dotenv()
 
-app = FastAPI(title="MCP Agent API (Azure + Qdrant + Firestore + SSE)")
+logger = logging.getLogger(__name__)
+
+# Background Firestore writes still in flight; drained on shutdown
+_pending_writes: Set[asyncio.Task] = set()
+
+
+async def _persist_turns(user_id: str, message: str, reply: str) -> None:
+    try:
+        await asyncio.to_thread(append_turns, user_id, [("user", message), ("assistant", reply)])
+    except Exception:
+        logger.exception("Failed to persist chat turns for user %s", user_id)
+
+
+def _schedule_persist(user_id: str, message: str, reply: str) -> None:
+    """Persist the turn pair off the request path (fire-and-forget)."""
+    task = asyncio.create_task(_persist_turns(user_id, message, reply))
+    _pending_writes.add(task)
+    task.add_done_callback(_pending_writes.discard)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    yield
+    if _pending_writes:
+        await asyncio.gather(*_pending_writes, return_exceptions=True)
+
+
+# Keep the default response class: with a response model (or return annotation) set,
+# FastAPI serializes straight to JSON bytes in pydantic-core. A custom class such as
+# ORJSONResponse would opt out of that path.
+app = FastAPI(title="MCP Agent API (Azure + Qdrant + Firestore + SSE)", lifespan=lifespan)
 
 origins = (
     [o.strip() for o in settings.cors_origins.split(",")]
@@ -97,32 +132,32 @@ async def chat(body: ChatRequest) -> ChatResponse:
       - retrieves guidance from Qdrant
       - composes grounded answer with citations + disclaimer
     """
-    history_raw = fetch_context(body.user_id, settings.max_context_messages)
+    history_raw = await asyncio.to_thread(fetch_context, body.user_id, settings.max_context_messages)
     history_msgs = _to_lc_history(history_raw)
 
     timeframe = body.timeframe.model_dump() if body.timeframe else _default_timeframe(7)
-    metric_kinds = body.metric_kinds or settings.default_metric_kinds
+    metric_kinds = body.metric_kinds or metric_config.default_metric_kinds
 
     initial_state = {
         "messages": history_msgs + [HumanMessage(content=body.message)],
         "user_id": body.user_id,
         "timeframe": timeframe,
         "metric_kinds": metric_kinds,
-        "metrics": [],
+        "metrics": {},
         "anomalies": [],
         "relevant_chunks": [],
         "citations": [],
         "safety_warnings": [],
     }
 
-    result = GRAPH.invoke(initial_state)
+    result = await GRAPH.ainvoke(initial_state)
 
     reply: str = (result.get("answer") or "").strip()
-    append_turn(body.user_id, "user", body.message)
-    append_turn(body.user_id, "assistant", reply)
-
     used = result.get("citations") or []
-    return ChatResponse(reply=reply, used_docs=used)
+    response = ChatResponse(reply=reply, used_docs=used)
+
+    _schedule_persist(body.user_id, body.message, reply)
+    return response
 
 
 @app.post(
@@ -133,20 +168,21 @@ async def chat_stream(body: ChatRequest) -> StreamingResponse:
     """
     Graph streaming as SSE:
       - Emits node progress events
+      - Emits answer token events as the model generates them
       - Emits final answer event
     """
-    history_raw = fetch_context(body.user_id, settings.max_context_messages)
+    history_raw = await asyncio.to_thread(fetch_context, body.user_id, settings.max_context_messages)
     history_msgs = _to_lc_history(history_raw)
 
     timeframe = body.timeframe.model_dump() if body.timeframe else _default_timeframe(7)
-    metric_kinds = body.metric_kinds or settings.default_metric_kinds
+    metric_kinds = body.metric_kinds or metric_config.default_metric_kinds
 
     initial_state = {
         "messages": history_msgs + [HumanMessage(content=body.message)],
         "user_id": body.user_id,
         "timeframe": timeframe,
         "metric_kinds": metric_kinds,
-        "metrics": [],
+        "metrics": {},
         "anomalies": [],
         "relevant_chunks": [],
         "citations": [],
@@ -156,7 +192,22 @@ async def chat_stream(body: ChatRequest) -> StreamingResponse:
     async def sse_gen() -> AsyncGenerator[bytes, None]:
         final_answer: str = ""
         try:
-            async for update in GRAPH.astream(initial_state, stream_mode="updates"):
+            async for mode, update in GRAPH.astream(
+                initial_state, stream_mode=["updates", "messages"]
+            ):
+                if mode == "messages":
+                    # LLM token chunks; only the answer node's model output is user-facing.
+                    # The node's returned AIMessage is emitted here too, so skip non-chunks.
+                    chunk, meta = update
+                    if not isinstance(chunk, AIMessageChunk) or meta.get("langgraph_node") != "answer":
+                        continue
+                    text = chunk.content
+                    if isinstance(text, str) and text:
+                        yield f"data: {json.dumps({'type': 'token', 'text': text})}\n\n".encode(
+                            "utf-8"
+                        )
+                    continue
+
                 node_name, payload = next(iter(update.items()))
                 maybe_state = payload or {}
 
@@ -172,9 +223,8 @@ async def chat_stream(body: ChatRequest) -> StreamingResponse:
                 }
                 yield f"data: {json.dumps(event)}\n\n".encode("utf-8")
 
-            # Persist after completion
-            append_turn(body.user_id, "user", body.message)
-            append_turn(body.user_id, "assistant", final_answer)
+            # Persist after completion, without holding up the stream
+            _schedule_persist(body.user_id, body.message, final_answer)
 
             yield f"data: {json.dumps({'type': 'final', 'answer': final_answer})}\n\n".encode(
                 "utf-8"
@@ -193,7 +243,8 @@ async def chat_stream(body: ChatRequest) -> StreamingResponse:
     dependencies=[Depends(api_key_auth)],
 )
 async def index_upsert(body: UpsertRequest) -> Dict[str, Any]:
-    ids = upsert_texts([i.model_dump() for i in body.items])
+    ids = await upsert_texts([i.model_dump() for i in body.items])
+    clear_retrieval_cache()
     return {"status": "ok", "ids": ids}
 
 
@@ -202,7 +253,8 @@ async def index_upsert(body: UpsertRequest) -> Dict[str, Any]:
     dependencies=[Depends(api_key_auth)],
 )
 async def index_delete(body: DeleteRequest) -> Dict[str, Any]:
-    delete_points(body.ids)
+    await delete_points(body.ids)
+    clear_retrieval_cache()
     return {"status": "ok"}
 
 
@@ -212,11 +264,22 @@ async def index_delete(body: DeleteRequest) -> Dict[str, Any]:
     dependencies=[Depends(api_key_auth)],
 )
 async def index_search(body: SearchRequest) -> SearchResponse:
-    docs = search(query=body.query, k=body.k, where=body.where)
+    docs = await search(query=body.query, k=body.k, where=body.where)
     results = [{"text": d.page_content, "metadata": d.metadata} for d in docs]
     return SearchResponse(results=results)
 
 
+@app.post(
+    settings.api_prefix + "/index/search/batch",
+    response_model=SearchBatchResponse,
+    dependencies=[Depends(api_key_auth)],
+)
+async def index_search_batch(body: SearchBatchRequest) -> SearchBatchResponse:
+    batches = await search_many(queries=body.queries, k=body.k, where=body.where)
+    results = [[{"text": d.page_content, "metadata": d.metadata} for d in docs] for docs in batches]
+    return SearchBatchResponse(results=results)
+
+
 # -----------------------------
 # Product Manager Configuration Endpoints
 # -----------------------------
@@ -236,8 +299,8 @@ async def get_metric_config() -> MetricConfigResponse:
     are currently configured for health analysis.
     """
     return MetricConfigResponse(
-        default_metric_kinds=settings.default_metric_kinds,
-        available_metric_kinds=settings.available_metric_kinds
+        default_metric_kinds=metric_config.default_metric_kinds,
+        available_metric_kinds=metric_config.available_metric_kinds
     )
 
 
@@ -264,18 +327,18 @@ async def update_metric_config(body: MetricConfigUpdateRequest) -> MetricConfigR
     """
     # Validate that default metrics are in available metrics
     if body.default_metric_kinds:
-        invalid_defaults = set(body.default_metric_kinds) - set(body.available_metric_kinds or settings.available_metric_kinds)
+        invalid_defaults = set(body.default_metric_kinds) - set(body.available_metric_kinds or metric_config.available_metric_kinds)
         if invalid_defaults:
             raise ValueError(f"Default metric kinds {invalid_defaults} are not in available metric kinds")
     
-    # Update settings (this will only persist for the current session)
+    # Update runtime overrides (this will only persist for the current session)
     if body.default_metric_kinds is not None:
-        settings.default_metric_kinds = body.default_metric_kinds
+        metric_config.default_metric_kinds = body.default_metric_kinds
     
     if body.available_metric_kinds is not None:
-        settings.available_metric_kinds = body.available_metric_kinds
+        metric_config.available_metric_kinds = body.available_metric_kinds
     
     return MetricConfigResponse(
-        default_metric_kinds=settings.default_metric_kinds,
-        available_metric_kinds=settings.available_metric_kinds
+        default_metric_kinds=metric_config.default_metric_kinds,
+        available_metric_kinds=metric_config.available_metric_kinds
     )
@@ -1,104 +1,303 @@
 # retriever.py
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional
+import asyncio
+import functools
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, List, Optional
 
 from langchain_openai import AzureOpenAIEmbeddings
-from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, Filter as QFilter, MatchValue, PointStruct, SearchParams, VectorParams
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    Distance,
+    FieldCondition,
+    Filter as QFilter,
+    HnswConfigDiff,
+    MatchValue,
+    PayloadSchemaType,
+    PointIdsList,
+    PointStruct,
+    QuantizationSearchParams,
+    QueryRequest,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+    VectorParams,
+)
 
 from .config import settings
 
 
-def _client() -> QdrantClient:
-    return QdrantClient(host=settings.qdrant_host, port=settings.qdrant_port, prefer_grpc=False, timeout=20.0)
+@dataclass(slots=True)
+class Doc:
+    """Search hit: the chunk text, its remaining payload fields, and the similarity score."""
 
+    page_content: str
+    metadata: Dict[str, Any]
+    score: float
 
+
+@functools.lru_cache(maxsize=1)
+def _client() -> AsyncQdrantClient:
+    return AsyncQdrantClient(
+        host=settings.qdrant_host,
+        port=settings.qdrant_port,
+        grpc_port=settings.qdrant_grpc_port,
+        prefer_grpc=settings.qdrant_prefer_grpc,
+        timeout=20.0,
+    )
+
+
+@functools.lru_cache(maxsize=1)
 def _embedder() -> AzureOpenAIEmbeddings:
     return AzureOpenAIEmbeddings(
         azure_deployment=settings.azure_embedding_deployment,
         api_key=settings.azure_openai_key,
         azure_endpoint=settings.azure_openai_endpoint,
         api_version=settings.azure_api_version,
+        chunk_size=settings.embedding_batch_size,  # inputs per embeddings request
     )
 
 
-def _ensure_collection() -> None:
-    client = _client()
-    colls = client.get_collections().collections
-    exists = any(c.name == settings.qdrant_collection for c in colls)
-    if not exists:
-        dist = Distance.COSINE if settings.qdrant_distance.upper() == "COSINE" else Distance.DOT
-        client.recreate_collection(
-            collection_name=settings.qdrant_collection,
-            vectors_config=VectorParams(size=settings.embedding_dim, distance=dist),
+def hnsw_ef(k: int, ef: Optional[int] = None) -> int:
+    """
+    HNSW search beam width for a top-k query: an explicit ef wins, otherwise
+    max(ef_base, k * ef_multiplier), capped at ef_max (and never below k).
+    """
+    if ef is None:
+        ef = max(settings.qdrant_hnsw_ef_base, k * settings.qdrant_hnsw_ef_multiplier)
+        ef = min(ef, settings.qdrant_hnsw_ef_max)
+    return max(ef, k)
+
+
+def search_params(k: int, ef: Optional[int] = None) -> SearchParams:
+    """
+    Search params shared by every query path: adaptive ef plus, when the collection
+    is quantized, oversampled int8 candidates rescored against the original vectors.
+    """
+    quantization = None
+    if settings.qdrant_scalar_quantization:
+        quantization = QuantizationSearchParams(
+            ignore=False, rescore=True, oversampling=settings.qdrant_oversampling
         )
+    return SearchParams(hnsw_ef=hnsw_ef(k, ef), quantization=quantization)
+
 
+_collection_ready = False
+_collection_lock = asyncio.Lock()
 
-def upsert_texts(items: List[Dict[str, Any]]) -> List[str]:
+
+async def _ensure_collection() -> None:
+    """
+    Create the collection if missing. Runs the check once per process; later
+    calls return without a round trip.
+    """
+    global _collection_ready
+    if _collection_ready:
+        return
+    async with _collection_lock:
+        if _collection_ready:
+            return
+        client = _client()
+        if not await client.collection_exists(settings.qdrant_collection):
+            dist = Distance.COSINE if settings.qdrant_distance.upper() == "COSINE" else Distance.DOT
+            quantization = None
+            if settings.qdrant_scalar_quantization:
+                # int8 copies of the vectors kept in RAM; originals are used for rescoring
+                quantization = ScalarQuantization(
+                    scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+                )
+            try:
+                await client.create_collection(
+                    collection_name=settings.qdrant_collection,
+                    vectors_config=VectorParams(size=settings.embedding_dim, distance=dist),
+                    hnsw_config=HnswConfigDiff(m=settings.qdrant_hnsw_m, ef_construct=settings.qdrant_hnsw_ef_construct),
+                    on_disk_payload=settings.qdrant_on_disk_payload,
+                    quantization_config=quantization,
+                )
+            except Exception:
+                # Another worker may have created it between the check and the create
+                if not await client.collection_exists(settings.qdrant_collection):
+                    raise
+        # Keyword indexes for `where` filter keys; re-creating an existing index is a no-op
+        for key in settings.qdrant_indexed_payload_keys:
+            await client.create_payload_index(
+                collection_name=settings.qdrant_collection,
+                field_name=key,
+                field_schema=PayloadSchemaType.KEYWORD,
+            )
+        _collection_ready = True
+
+
+async def _embed_documents(texts: List[str]) -> List[List[float]]:
+    """
+    Embed texts in sub-batches of embedding_batch_size, with at most
+    embedding_concurrency requests in flight. Texts are sorted longest-first so
+    each batch holds similar lengths (and the slowest batches start first);
+    output order matches input order.
+    """
+    emb = _embedder()
+    size = max(1, settings.embedding_batch_size)
+    sem = asyncio.Semaphore(max(1, settings.embedding_concurrency))
+
+    async def _one(batch: List[str]) -> List[List[float]]:
+        async with sem:
+            return await emb.aembed_documents(batch)
+
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+    ordered = [texts[i] for i in order]
+    batches = [ordered[i : i + size] for i in range(0, len(ordered), size)]
+    results = await asyncio.gather(*(_one(b) for b in batches))
+
+    vectors: List[List[float]] = [None] * len(texts)  # type: ignore[list-item]
+    for pos, vec in zip(order, (v for batch in results for v in batch)):
+        vectors[pos] = vec
+    return vectors
+
+
+async def upsert_texts(items: List[Dict[str, Any]]) -> List[str]:
     """
     Upsert plain texts with optional metadata.
     Each item: {"text": "...", "metadata": {...}, "id": "optional"}
+    Returns the point ids in item order, including generated UUIDs.
     """
-    _ensure_collection()
-    emb = _embedder()
+    await _ensure_collection()
     client = _client()
 
-    payloads: List[Dict[str, Any]] = []
-    points: List[PointStruct] = []
-    ids: List[str] = []
-
     texts = [i["text"] for i in items]
-    vectors = emb.embed_documents(texts)
+    # Embed each distinct text once and scatter the vectors back to every copy
+    unique = list(dict.fromkeys(texts))
+    by_text = dict(zip(unique, await _embed_documents(unique)))
+    vectors = [by_text[t] for t in texts]
+
+    # Qdrant requires an id on every point; generate one when the caller omits it
+    points = [
+        PointStruct(
+            id=item.get("id") or str(uuid.uuid4()),
+            vector=vec,
+            payload={"text": item["text"], **(item.get("metadata") or {})},
+        )
+        for item, vec in zip(items, vectors)
+    ]
 
-    for i, item in enumerate(items):
-        pid = item.get("id") or None
-        meta = item.get("metadata") or {}
-        payload = {"text": item["text"], **meta}
-        payloads.append(payload)
-        point = PointStruct(id=pid, vector=vectors[i], payload=payload)  # Qdrant will assign id if None
-        points.append(point)
+    # Fixed-size batches with a bounded number in flight; wait=False lets the
+    # server pipeline WAL/indexing instead of acknowledging each batch synchronously.
+    size = max(1, settings.qdrant_upsert_batch_size)
+    sem = asyncio.Semaphore(max(1, settings.qdrant_upsert_concurrency))
 
-    client.upsert(collection_name=settings.qdrant_collection, points=points)
-    # Collect actual ids
-    for p in points:
-        ids.append(str(p.id) if p.id is not None else "")
-    return ids
+    async def _upsert(batch: List[PointStruct]) -> None:
+        async with sem:
+            await client.upsert(collection_name=settings.qdrant_collection, points=batch, wait=False)
 
+    await asyncio.gather(*(_upsert(points[i : i + size]) for i in range(0, len(points), size)))
+    return [str(p.id) for p in points]
 
-def search(query: str, k: int = 5, where: Optional[Dict[str, Any]] = None):
+
+@functools.lru_cache(maxsize=1024, typed=True)
+def _build_filter(key: str, value: Hashable) -> QFilter:
+    # Typed models, validated once per distinct (key, value); typed=True keeps True/1/1.0 apart
+    return QFilter(must=[FieldCondition(key=key, match=MatchValue(value=value))])
+
+
+def _where_filter(where: Optional[Dict[str, Any]]) -> Optional[QFilter]:
+    # Example: where={"key": "category", "value": "health"}
+    if where and "key" in where and "value" in where:
+        try:
+            return _build_filter(where["key"], where["value"])
+        except TypeError:  # unhashable value; build uncached and let validation decide
+            return QFilter(must=[FieldCondition(key=where["key"], match=MatchValue(value=where["value"]))])
+    return None
+
+
+def _to_doc(payload: Optional[Dict[str, Any]], score: float) -> Doc:
+    metadata = dict(payload) if payload else {}
+    text = metadata.pop("text", None)
+    return Doc(
+        page_content=text or metadata.get("page_content") or "",
+        metadata=metadata,
+        score=score,
+    )
+
+
+async def search(
+    query: str,
+    k: int = 5,
+    where: Optional[Dict[str, Any]] = None,
+    ef: Optional[int] = None,
+) -> List[Doc]:
     """
     Perform a vector search with optional metadata filter (QFilter).
-    Returns a list of lightweight objects with page_content + metadata for convenience.
+    Returns a list of Doc (page_content + metadata + score) for convenience.
     """
     emb = _embedder()
     client = _client()
-    qvec = emb.embed_query(query)
+    qvec = await emb.aembed_query(query)
 
-    qfilter: Optional[QFilter] = None
-    # Example: where={"key": "category", "value": "health"}
-    if where and "key" in where and "value" in where:
-        qfilter = QFilter(must=[{"key": where["key"], "match": MatchValue(value=where["value"])}])
-
-    results = client.search(
+    results = await client.query_points(
         collection_name=settings.qdrant_collection,
-        query_vector=qvec,
+        query=qvec,
         limit=k,
-        query_filter=qfilter,
+        query_filter=_where_filter(where),
         with_payload=True,
         with_vectors=False,
-        search_params=SearchParams(hnsw_ef=128),
+        search_params=search_params(k, ef),
+    )
+
+    return [_to_doc(hit.payload, hit.score) for hit in results.points]
+
+
+async def search_many(
+    queries: List[str],
+    k: int = 5,
+    where: Optional[Dict[str, Any]] = None,
+    ef: Optional[int] = None,
+) -> List[List[Doc]]:
+    """
+    Search several queries at once: one embeddings request for all queries and one
+    Qdrant query_batch_points RPC. Results are returned in query order.
+    """
+    if not queries:
+        return []
+    emb = _embedder()
+    client = _client()
+    qvecs = await emb.aembed_documents(queries)
+
+    qfilter = _where_filter(where)
+    params = search_params(k, ef)
+    batches = await client.query_batch_points(
+        collection_name=settings.qdrant_collection,
+        requests=[
+            QueryRequest(query=v, limit=k, filter=qfilter, with_payload=True, params=params)
+            for v in qvecs
+        ],
     )
+    return [
+        [_to_doc(hit.payload, hit.score) for hit in batch.points]
+        for batch in batches
+    ]
 
-    class _Doc:
-        def __init__(self, payload: Dict[str, Any], score: float):
-            self.page_content = payload.get("text") or payload.get("page_content") or ""
-            self.metadata = {k: v for k, v in payload.items() if k != "text"}
-            self.score = score
 
-    return [_Doc(hit.payload or {}, float(hit.score or 0.0)) for hit in results]
+_DELETE_BATCH_SIZE = 1000
 
 
-def delete_points(ids: List[str]) -> None:
+async def delete_points(ids: List[str]) -> None:
+    """
+    Delete points by id without waiting for the WAL sync (wait=False). Large id
+    lists go out in batches, sharing the upsert write-concurrency budget.
+    """
     client = _client()
-    client.delete(collection_name=settings.qdrant_collection, points_selector={"points": ids})
+    sem = asyncio.Semaphore(max(1, settings.qdrant_upsert_concurrency))
+
+    async def _delete(batch: List[str]) -> None:
+        async with sem:
+            await client.delete(
+                collection_name=settings.qdrant_collection,
+                points_selector=PointIdsList(points=batch),
+                wait=False,
+            )
+
+    await asyncio.gather(
+        *(_delete(ids[i : i + _DELETE_BATCH_SIZE]) for i in range(0, len(ids), _DELETE_BATCH_SIZE))
+    )
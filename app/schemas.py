@@ -3,15 +3,26 @@ from __future__ import annotations
 
 from typing import Any, Dict, List, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
-class Timeframe(BaseModel):
+class _Schema(BaseModel):
+    # Plain pydantic-core fast path: unknown keys dropped, no assignment
+    # re-validation, no string munging.
+    model_config = ConfigDict(
+        extra="ignore",
+        validate_assignment=False,
+        str_strip_whitespace=False,
+        arbitrary_types_allowed=False,
+    )
+
+
+class Timeframe(_Schema):
     start: str = Field(..., description="ISO8601 UTC start, e.g., 2025-09-13T00:00:00Z")
     end: str = Field(..., description="ISO8601 UTC end, e.g., 2025-09-20T00:00:00Z")
 
 
-class ChatRequest(BaseModel):
+class ChatRequest(_Schema):
     user_id: str
     message: str
     metadata: Optional[Dict[str, Any]] = None
@@ -22,45 +33,55 @@ class ChatRequest(BaseModel):
     )
 
 
-class ChatResponse(BaseModel):
+class ChatResponse(_Schema):
     reply: str
     used_docs: Optional[List[Dict[str, Any]]] = None
 
 
-class UpsertItem(BaseModel):
+class UpsertItem(_Schema):
     text: str
     metadata: Optional[Dict[str, Any]] = None
     id: Optional[str] = None
 
 
-class UpsertRequest(BaseModel):
+class UpsertRequest(_Schema):
     items: List[UpsertItem]
 
 
-class DeleteRequest(BaseModel):
+class DeleteRequest(_Schema):
     ids: List[str]
 
 
-class SearchRequest(BaseModel):
+class SearchRequest(_Schema):
     query: str
     k: int = 5
     where: Optional[Dict[str, Any]] = None
 
 
-class SearchResultItem(BaseModel):
+class SearchResultItem(_Schema):
     text: str
     metadata: Dict[str, Any]
 
 
-class SearchResponse(BaseModel):
+class SearchResponse(_Schema):
     results: List[SearchResultItem]
 
 
-class MetricConfigResponse(BaseModel):
+class SearchBatchRequest(_Schema):
+    queries: List[str]
+    k: int = 5
+    where: Optional[Dict[str, Any]] = None
+
+
+class SearchBatchResponse(_Schema):
+    results: List[List[SearchResultItem]]
+
+
+class MetricConfigResponse(_Schema):
     default_metric_kinds: List[str]
     available_metric_kinds: List[str]
 
 
-class MetricConfigUpdateRequest(BaseModel):
+class MetricConfigUpdateRequest(_Schema):
     default_metric_kinds: Optional[List[str]] = None
     available_metric_kinds: Optional[List[str]] = None
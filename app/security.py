@@ -1,6 +1,11 @@
+import hmac
+
 from fastapi import Header, HTTPException, status
 from .config import settings
 
+# Resolved once; settings are frozen after load
+_API_KEY_BYTES = settings.api_key.encode("utf-8")
+
 async def api_key_auth(x_api_key: str = Header(None)) -> None:
-    if not x_api_key or x_api_key != settings.api_key:
+    if not x_api_key or not hmac.compare_digest(x_api_key.encode("utf-8"), _API_KEY_BYTES):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or missing API key.")
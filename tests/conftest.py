@@ -0,0 +1,10 @@
+import os
+
+# Settings are required at import time; point everything at dummy/local values
+os.environ.setdefault("API_KEY", "test-key")
+os.environ.setdefault("AZURE_OPENAI_KEY", "test")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://example.invalid")
+os.environ.setdefault("AZURE_DEPLOYMENT_NAME", "chat")
+os.environ.setdefault("AZURE_EMBEDDING_DEPLOYMENT", "embed")
+os.environ.setdefault("GCP_PROJECT_ID", "test-project")
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "127.0.0.1:8081")
@@ -0,0 +1,62 @@
+import app.agent as agent
+from app.agent import _NearestQueryCache
+
+
+def test_retrieval_cache_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(agent.time, "monotonic", lambda: now[0])
+    cache = _NearestQueryCache(capacity=4, threshold=0.98, ttl=60)
+    v = cache.unit([1.0, 0.0, 0.0])
+
+    cache.put(v, "hit")
+    assert cache.get(v) == "hit"
+    now[0] += 61
+    assert cache.get(v) is None
+
+    # The expired slot is reused before the cache grows
+    cache.put(cache.unit([0.0, 1.0, 0.0]), "fresh")
+    assert len(cache._results) == 1
+
+
+def test_metric_only_questions_skip_guidance():
+    assert agent._is_metric_only("What was my average HR last week?")
+    assert agent._is_metric_only("What is the mean of my steps?")
+    assert agent._is_metric_only("How many steps did I take?")
+    assert agent._is_metric_only("what's my total steps this week")
+    assert agent._is_metric_only("What was the average of my resting heart rate over the last 7 days?")
+
+
+def test_interpretive_questions_need_guidance():
+    assert not agent._is_metric_only("What does it mean if my resting HR is 45?")
+    assert not agent._is_metric_only("Is my sleep trend bad?")
+    assert not agent._is_metric_only("Should I worry about my HRV trend?")
+    assert not agent._is_metric_only("Is my average HR healthy?")
+    assert not agent._is_metric_only("My HR averaged 45 - does that mean I'm fit?")
+    assert not agent._is_metric_only("How many hours of sleep do adults need?")
+    assert not agent._is_metric_only("What is the average resting heart rate for women my age?")
+    assert not agent._is_metric_only("Is my HR dangerous?")
+    assert not agent._is_metric_only("Is my HR too high?")
+    assert not agent._is_metric_only("My HR is 180 at rest and I feel dizzy")
+    assert not agent._is_metric_only("my hr spikes whenever I stand up, is that POTS?")
+    assert not agent._is_metric_only("My steps are low, any tips?")
+    assert not agent._is_metric_only("what is the total recommended sleep")
+    assert not agent._is_metric_only("What was my average HR last week and is that too high?")
+    assert not agent._is_metric_only("What was my average HR while I felt dizzy?")
+
+
+def _chunks(n, text="x" * 200):
+    return [{"text": text, "metadata": {"source": f"doc{i}"}} for i in range(n)]
+
+
+def test_format_context_never_emits_partial_header():
+    assert agent._format_context(_chunks(3), max_chars=30) == ""
+
+    out = agent._format_context(_chunks(3), max_chars=300)
+    assert len(out) <= 300
+    assert out.count("[SOURCE: ") == 1 and out.startswith("[SOURCE: doc0]\n")
+
+
+def test_format_context_truncates_text_of_last_chunk():
+    out = agent._format_context(_chunks(3), max_chars=350)
+    assert len(out) == 350
+    assert out.count("[SOURCE: ") == 2 and "[SOURCE: doc1]\n" in out
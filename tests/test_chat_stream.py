@@ -0,0 +1,38 @@
+import json
+
+from fastapi.testclient import TestClient
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+import app.agent as agent
+import app.main as main
+
+MODEL_OUTPUT = "Hello there friend"
+
+
+def _events(body: str):
+    for line in body.splitlines():
+        if line.startswith("data: ") and line != "data: [DONE]":
+            yield json.loads(line[len("data: "):])
+
+
+def test_stream_tokens_match_model_output(monkeypatch):
+    monkeypatch.setattr(agent, "_chat", lambda: GenericFakeChatModel(messages=iter([AIMessage(content=MODEL_OUTPUT)])))
+    monkeypatch.setattr(agent, "get_user_metrics", lambda *a, **kw: {})
+    monkeypatch.setattr(main, "fetch_context", lambda *a, **kw: [])
+    monkeypatch.setattr(main, "_schedule_persist", lambda *a, **kw: None)
+
+    with TestClient(main.app) as client:
+        resp = client.post(
+            main.settings.api_prefix + "/chat/stream",
+            headers={"x-api-key": main.settings.api_key},
+            json={"user_id": "u1", "message": "What was my average HR?"},
+        )
+    assert resp.status_code == 200
+
+    events = list(_events(resp.text))
+    tokens = [e["text"] for e in events if e["type"] == "token"]
+    final = [e for e in events if e["type"] == "final"]
+
+    assert "".join(tokens) == MODEL_OUTPUT
+    assert len(final) == 1 and final[0]["answer"].startswith(MODEL_OUTPUT)
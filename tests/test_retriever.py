@@ -0,0 +1,32 @@
+import asyncio
+import uuid
+
+from qdrant_client import AsyncQdrantClient
+
+import app.retriever as retriever
+from app.retriever import _where_filter
+
+
+class _FakeEmbedder:
+    async def aembed_documents(self, texts):
+        return [[1.0] + [0.0] * (retriever.settings.embedding_dim - 1) for _ in texts]
+
+
+def test_where_filter_cache_keeps_bool_and_int_apart():
+    as_bool = _where_filter({"key": "flag", "value": True})
+    as_int = _where_filter({"key": "flag", "value": 1})
+    assert as_bool.must[0].match.value is True
+    assert as_int.must[0].match.value == 1 and as_int.must[0].match.value is not True
+
+
+def test_upsert_generates_ids_for_items_without_one(monkeypatch):
+    client = AsyncQdrantClient(location=":memory:")
+    monkeypatch.setattr(retriever, "_client", lambda: client)
+    monkeypatch.setattr(retriever, "_embedder", lambda: _FakeEmbedder())
+    given = str(uuid.uuid4())
+
+    ids = asyncio.run(retriever.upsert_texts([{"text": "a"}, {"text": "b", "id": given}]))
+
+    assert ids[1] == given
+    assert uuid.UUID(ids[0])
+    assert asyncio.run(client.count(retriever.settings.qdrant_collection)).count == 2